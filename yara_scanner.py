@@ -7,11 +7,19 @@ Can use bundled rules and/or user-provided rules.
 """
 
 import argparse
+import hashlib
+import io
 import json
+import mmap
 import os
+import re
 import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Optional
+from typing import Any, BinaryIO, Iterable, Iterator, Optional, TextIO
 
 try:
     import yara
@@ -19,13 +27,152 @@ except ImportError:
     print("Error: yara-python is not installed. Run: pip install yara-python", file=sys.stderr)
     sys.exit(1)
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Number of files handed to a worker per task, and how many tasks may be
+# queued per worker before results are drained
+SCAN_BATCH_SIZE = 16
+SCAN_QUEUE_DEPTH = 4
+
+# File extensions skipped by default, as they never hold code YARA rules target
+SKIP_EXTS = frozenset({'.map', '.png', '.jpg', '.ico', '.woff', '.woff2', '.ttf'})
+
+# Files up to this size are read into a reused buffer instead of mapped
+SMALL_FILE_SIZE = 64 * 1024
+
+# Larger files are scanned by path, since mapping them can fail on Windows
+MMAP_MAX_SIZE = 2**31 - 1 if os.name == 'nt' else sys.maxsize
+
+# Rule severities counted as high severity matches
+HIGH_SEVERITIES = frozenset({'critical', 'high'})
+
+# GitHub annotation command for each rule severity; others become notices
+_SEV_PREFIX = {'critical': '::error', 'high': '::error', 'medium': '::warning'}
+
+# Shared default for matches without metadata; never modified
+_EMPTY = {}
+
+# Compiled rules are cached here, keyed by a hash of the rule sources.
+# Only the most recently used entries are kept.
+RULE_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'uc-software-scan'
+RULE_CACHE_MAX_ENTRIES = 8
+
+# YARA include directive; the path is relative to the including file
+INCLUDE_RE = re.compile(rb'^[ \t]*include[ \t]+"([^"]+)"', re.MULTILINE)
+
+# Compiled rules loaded once per worker process by _init_worker
+_worker_rules: Optional[yara.Rules] = None
 
-def load_rules(rules_paths: list[str]) -> Optional[yara.Rules]:
+# Read buffer for small files, allocated once per process
+_small_file_buffer = memoryview(bytearray(SMALL_FILE_SIZE))
+
+
+def rule_cache_path(rule_files: dict[str, str]) -> Optional[Path]:
+    """
+    Get the compiled rules cache file for a set of rule files.
+    
+    The key covers the yara-python version and the path, mtime and contents
+    of each rule file and of every file it pulls in through YARA include
+    directives, so editing any of them produces a new cache entry.
+    
+    Args:
+        rule_files: Mapping of namespace to rule file path
+        
+    Returns:
+        Path of the cached compiled rules file, or None if an included file
+        cannot be read and the rules should not be cached
+    """
+    digest = hashlib.blake2b(yara.__version__.encode(), digest_size=16)
+    pending = deque(sorted(rule_files.items()))
+    seen = set()
+    
+    while pending:
+        namespace, path = pending.popleft()
+        real_path = os.path.realpath(path)
+        if real_path in seen:
+            continue
+        seen.add(real_path)
+        
+        try:
+            with open(path, 'rb') as f:
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+                source = f.read()
+        except OSError as e:
+            print(f"Warning: Not caching compiled rules, cannot read {path}: {e}", file=sys.stderr)
+            return None
+        
+        digest.update(f"\0{namespace}\0{path}\0{mtime}\0".encode())
+        digest.update(source)
+        
+        for include in INCLUDE_RE.finditer(source):
+            include_path = os.path.join(os.path.dirname(path), os.fsdecode(include.group(1)))
+            pending.append(('include', include_path))
+    
+    return RULE_CACHE_DIR / f"rules-{digest.hexdigest()}.yarac"
+
+
+def prune_rule_cache(keep: int = RULE_CACHE_MAX_ENTRIES) -> None:
+    """
+    Remove all but the most recently used compiled rules cache entries.
+    
+    Args:
+        keep: Number of entries to keep
+    """
+    def last_used(path: Path) -> int:
+        try:
+            return path.stat().st_mtime_ns
+        except OSError:
+            return 0
+    
+    entries = sorted(RULE_CACHE_DIR.glob('rules-*.yarac'), key=last_used, reverse=True)
+    for entry in entries[keep:]:
+        try:
+            entry.unlink()
+        except OSError:
+            pass
+
+
+def save_rule_cache(rules: yara.Rules, cache_path: Path) -> None:
+    """
+    Atomically write compiled rules to the cache.
+    
+    Args:
+        rules: Compiled YARA rules
+        cache_path: Destination cache file
+    """
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix='.rules-', suffix='.tmp')
+        os.close(fd)
+        try:
+            rules.save(tmp_path)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except (OSError, yara.Error) as e:
+        print(f"Warning: Could not write rule cache {cache_path}: {e}", file=sys.stderr)
+        return
+    
+    prune_rule_cache()
+
+
+def load_rules(rules_paths: list[str], use_cache: bool = True) -> Optional[yara.Rules]:
     """
     Load and compile YARA rules from multiple paths.
     
     Args:
         rules_paths: List of paths to .yar files or directories containing them
+        use_cache: Reuse previously compiled rules from RULE_CACHE_DIR
         
     Returns:
         Compiled YARA rules object or None if no rules found
@@ -57,15 +204,72 @@ def load_rules(rules_paths: list[str]) -> Optional[yara.Rules]:
     for namespace, path in rule_files.items():
         print(f"  - {namespace}: {path}", file=sys.stderr)
     
+    cache_path = rule_cache_path(rule_files) if use_cache else None
+    if cache_path and cache_path.is_file():
+        try:
+            rules = yara.load(str(cache_path))
+            print(f"Using cached compiled rules: {cache_path}", file=sys.stderr)
+            # Mark the entry as recently used so pruning keeps it
+            try:
+                os.utime(cache_path)
+            except OSError:
+                pass
+            return rules
+        except yara.Error as e:
+            print(f"Warning: Ignoring unreadable rule cache {cache_path}: {e}", file=sys.stderr)
+    
     try:
         rules = yara.compile(filepaths=rule_files)
-        return rules
     except yara.SyntaxError as e:
         print(f"Error compiling YARA rules: {e}", file=sys.stderr)
         sys.exit(1)
+    
+    if cache_path:
+        save_rule_cache(rules, cache_path)
+    
+    return rules
+
+
+def match_file(rules: yara.Rules, file_path: str, timeout: int = 60, size: Optional[int] = None) -> list:
+    """
+    Run YARA rules against a file's contents.
+    
+    Small files are read into a buffer that is reused for every scan in this
+    process, since setting up a mapping costs more than scanning them. Larger
+    files are scanned through a read-only memory map so YARA reads the page
+    cache directly instead of a private copy.
+    
+    Scans run in YARA's fast mode: once a string has matched, YARA stops
+    looking for more instances of it. Only the first instance of each string
+    is reported, and strings whose count or offsets a rule condition uses
+    (#s, @s[i]) are still matched in full, so results are unaffected.
+    
+    Args:
+        rules: Compiled YARA rules
+        file_path: Path to file to scan
+        timeout: Scan timeout in seconds
+        size: File size from an earlier stat, or None to stat the open file
+        
+    Returns:
+        List of yara.Match objects
+    """
+    with open(file_path, 'rb', buffering=0) as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        
+        if size <= SMALL_FILE_SIZE:
+            length = f.readinto(_small_file_buffer[:size])
+            return rules.match(data=_small_file_buffer[:length], timeout=timeout, fast=True)
+        if size > MMAP_MAX_SIZE:
+            return rules.match(file_path, timeout=timeout, fast=True)
+        
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            return rules.match(data=mm, timeout=timeout, fast=True)
 
 
-def scan_file(rules: yara.Rules, file_path: str, timeout: int = 60) -> list[dict]:
+def scan_file(rules: yara.Rules, file_path: str, timeout: int = 60, size: Optional[int] = None) -> list[dict]:
     """
     Scan a single file with YARA rules.
     
@@ -73,6 +277,7 @@ def scan_file(rules: yara.Rules, file_path: str, timeout: int = 60) -> list[dict
         rules: Compiled YARA rules
         file_path: Path to file to scan
         timeout: Scan timeout in seconds
+        size: File size from an earlier stat, or None to stat the file
         
     Returns:
         List of match dictionaries
@@ -80,7 +285,7 @@ def scan_file(rules: yara.Rules, file_path: str, timeout: int = 60) -> list[dict
     matches = []
     
     try:
-        results = rules.match(file_path, timeout=timeout)
+        results = match_file(rules, file_path, timeout, size)
         for match in results:
             match_data = {
                 'rule': match.rule,
@@ -90,7 +295,8 @@ def scan_file(rules: yara.Rules, file_path: str, timeout: int = 60) -> list[dict
                 'strings': []
             }
             
-            # Extract matched strings (limit to first 10 to avoid huge output)
+            # Extract matched strings (limit to first 10 to avoid huge output).
+            # Fast mode leaves only the first instance of most strings.
             for string_match in match.strings[:10]:
                 match_data['strings'].append({
                     'identifier': string_match.identifier,
@@ -109,63 +315,252 @@ def scan_file(rules: yara.Rules, file_path: str, timeout: int = 60) -> list[dict
     return matches
 
 
-def scan_files_from_json(rules: yara.Rules, json_path: str, timeout: int = 60) -> dict:
+def _init_worker(rules_path: str) -> None:
+    """Load the compiled rules saved by scan_files into this worker process."""
+    global _worker_rules
+    _worker_rules = yara.load(rules_path)
+
+
+def _scan_batch(files: list[tuple[str, Optional[int]]], timeout: int) -> list[list[dict]]:
+    """Scan a batch of (file_path, size) pairs inside a worker process."""
+    return [scan_file(_worker_rules, file_path, timeout, size) for file_path, size in files]
+
+
+def scan_files(rules: yara.Rules, targets: Iterable[tuple[Any, Optional[str], Optional[int]]],
+               timeout: int = 60, workers: int = 1) -> Iterator[tuple[Any, Optional[list[dict]]]]:
     """
-    Scan files listed in binary-scan-results.json.
-    
+    Scan many files, spreading the work across a pool of processes.
+
+    Compiled rules cannot be pickled, so they are saved to a temporary file
+    once and each worker loads its own copy when it starts.
+
+    Targets with a file_path of None are not scanned; they are yielded back
+    with None matches in their place in the order, so callers can fill in
+    results they already have.
+
     Args:
         rules: Compiled YARA rules
-        json_path: Path to binary-scan-results.json
+        targets: Iterable of (context, file_path, size) tuples, where size
+            comes from an earlier stat or is None
         timeout: Scan timeout per file
-        
-    Returns:
-        Dictionary with scan results
+        workers: Number of worker processes (1 scans in this process)
+
+    Yields:
+        (context, matches) pairs in the same order as targets
+    """
+    targets = iter(targets)
+
+    if workers <= 1:
+        for context, file_path, size in targets:
+            yield context, scan_file(rules, file_path, timeout, size) if file_path is not None else None
+        return
+
+    fd, rules_path = tempfile.mkstemp(prefix='uc-yara-', suffix='.yarc')
+    os.close(fd)
+
+    try:
+        rules.save(rules_path)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(rules_path,)) as executor:
+            # Keep a bounded window of batches in flight so results are
+            # yielded in order while targets are still being produced
+            pending = deque()
+            while True:
+                batch = list(islice(targets, SCAN_BATCH_SIZE))
+                if batch:
+                    files = [(file_path, size) for _, file_path, size in batch if file_path is not None]
+                    future = executor.submit(_scan_batch, files, timeout) if files else None
+                    pending.append((batch, future))
+
+                while pending and (not batch or len(pending) >= workers * SCAN_QUEUE_DEPTH):
+                    done, future = pending.popleft()
+                    batch_matches = iter(future.result() if future else ())
+                    for context, file_path, _ in done:
+                        yield context, next(batch_matches) if file_path is not None else None
+
+                if not batch:
+                    break
+    finally:
+        os.unlink(rules_path)
+
+
+def write_lines(stream: TextIO, lines: list[str]) -> None:
     """
-    with open(json_path, 'r') as f:
-        scan_results = json.load(f)
+    Write lines to a standard stream's file descriptor with one os.write call.
     
-    base_path = Path(json_path).parent
-    node_modules = base_path / 'node_modules'
+    Anything already buffered in the stream is flushed first so output stays
+    in order. Streams without a file descriptor are written to normally.
+    
+    Args:
+        stream: sys.stdout or sys.stderr
+        lines: Lines to write, without trailing newlines
+    """
+    text = '\n'.join(lines) + '\n'
+    stream.flush()
+    try:
+        fd = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        stream.write(text)
+        return
     
-    yara_results = {
+    # Undecodable bytes in file names are written back out unchanged
+    data = memoryview(text.encode('utf-8', 'surrogateescape'))
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def flush_log(log: io.StringIO) -> None:
+    """
+    Write buffered log lines to stderr in a single call and empty the buffer.
+    
+    Args:
+        log: Buffer collecting progress and match lines
+    """
+    sys.stderr.write(log.getvalue())
+    log.seek(0)
+    log.truncate()
+
+
+def new_totals() -> dict:
+    """Create the scan counters updated by scan_files_from_json and scan_directory."""
+    return {
         'totalScanned': 0,
+        'totalSkipped': 0,
         'totalMatches': 0,
+        'highSeverityMatches': 0,
         'filesWithMatches': 0,
-        'results': []
     }
+
+
+def is_skipped(file_path: str, size: int, skip_exts: frozenset = SKIP_EXTS,
+               max_size: Optional[int] = None) -> bool:
+    """
+    Check whether a file can be left out of the scan without running YARA.
+    
+    Args:
+        file_path: Path to the file
+        size: File size in bytes
+        skip_exts: Lowercase file extensions to skip (e.g., {'.png'})
+        max_size: Skip files larger than this many bytes, or None for no limit
+        
+    Returns:
+        True if the file is empty, too large, or has a skipped extension
+    """
+    if size == 0 or (max_size is not None and size > max_size):
+        return True
+    return os.path.splitext(file_path)[1].lower() in skip_exts
+
+
+def iter_packages(json_path: str) -> Iterator[dict]:
+    """
+    Read package entries from binary-scan-results.json one at a time.
+    
+    When ijson is installed the report is parsed incrementally, so scanning
+    starts before the whole file has been read and only the current package
+    is held in memory. Otherwise the report is loaded with json.
+    
+    Args:
+        json_path: Path to binary-scan-results.json
+        
+    Yields:
+        Package dictionaries from the report's packages list
+    """
+    with open(json_path, 'rb') as f:
+        if ijson is None:
+            yield from json.load(f).get('packages', [])
+        else:
+            yield from ijson.items(f, 'packages.item', use_float=True)
+
+
+def scan_files_from_json(rules: yara.Rules, json_path: str, totals: dict, timeout: int = 60,
+                         workers: int = 1, skip_exts: frozenset = frozenset(),
+                         max_size: Optional[int] = None) -> Iterator[dict]:
+    """
+    Scan files listed in binary-scan-results.json.
+    
+    Args:
+        rules: Compiled YARA rules
+        json_path: Path to binary-scan-results.json
+        totals: Counters from new_totals(), updated as files are scanned
+        timeout: Scan timeout per file
+        workers: Number of worker processes
+        skip_exts: Lowercase file extensions to skip
+        max_size: Skip files larger than this many bytes, or None for no limit
+        
+    Yields:
+        Result dictionary for each file with matches
+    """
+    # Report paths are relative, so full paths are built by prefixing these
+    # once-resolved directories instead of joining per file
+    base_prefix = os.path.join(str(Path(json_path).parent), '')
+    node_modules_prefix = os.path.join(base_prefix, 'node_modules', '')
+    
+    # The number of files is not known until the report has been read, so
+    # progress is reported as a running count
+    print(f"\nScanning files listed in {json_path} with YARA...", file=sys.stderr)
     
-    packages = scan_results.get('packages', [])
-    total_files = sum(len(pkg.get('files', [])) for pkg in packages)
+    # Identical files are often vendored into several packages, so each
+    # SHA-256 is scanned once and later copies reuse its matches
+    scanned_by_hash = {}
+    submitted_hashes = set()
+    
+    def targets():
+        for package in iter_packages(json_path):
+            for executable in package.get('files', []):
+                file_path = executable.get('file', '')
+                
+                # Construct full path
+                if file_path.startswith('node_modules/'):
+                    full_path = base_prefix + file_path
+                else:
+                    full_path = node_modules_prefix + file_path
+                
+                try:
+                    size = os.stat(full_path).st_size
+                except OSError:
+                    print(f"Warning: File not found: {full_path}", file=log)
+                    continue
+                
+                if is_skipped(file_path, size, skip_exts, max_size):
+                    totals['totalSkipped'] += 1
+                    continue
+                
+                sha256 = executable.get('sha256', '')
+                if sha256 in submitted_hashes:
+                    yield (package, executable), None, None
+                    continue
+                if sha256:
+                    submitted_hashes.add(sha256)
+                
+                yield (package, executable), full_path, size
     
-    print(f"\nScanning {total_files} files with YARA...", file=sys.stderr)
+    # Progress and match lines are written to stderr together at each
+    # progress update rather than one write per line
+    log = io.StringIO()
     
     scanned = 0
-    for package in packages:
-        for executable in package.get('files', []):
+    try:
+        for (package, executable), matches in scan_files(rules, targets(), timeout, workers):
             file_path = executable.get('file', '')
             
-            # Construct full path
-            if file_path.startswith('node_modules/'):
-                full_path = base_path / file_path
-            else:
-                full_path = node_modules / file_path
-            
-            if not full_path.exists():
-                print(f"Warning: File not found: {full_path}", file=sys.stderr)
-                continue
+            # The first file with this hash is always yielded before its copies
+            sha256 = executable.get('sha256', '')
+            if matches is None:
+                matches = scanned_by_hash[sha256]
+            elif sha256:
+                scanned_by_hash[sha256] = matches
             
             scanned += 1
-            if scanned % 10 == 0 or scanned == total_files:
-                print(f"  Progress: {scanned}/{total_files}", file=sys.stderr)
-            
-            matches = scan_file(rules, str(full_path), timeout)
-            
-            yara_results['totalScanned'] += 1
+            if scanned % 10 == 0:
+                print(f"  Progress: {scanned} files", file=log)
+                flush_log(log)
             
+            totals['totalScanned'] += 1
+        
             if matches:
-                yara_results['totalMatches'] += len(matches)
-                yara_results['filesWithMatches'] += 1
-                
+                totals['totalMatches'] += len(matches)
+                totals['filesWithMatches'] += 1
+            
                 result = {
                     'file': file_path,
                     'package': package.get('package', 'unknown'),
@@ -174,113 +569,338 @@ def scan_files_from_json(rules: yara.Rules, json_path: str, timeout: int = 60) -
                     'type': executable.get('type', ''),
                     'matches': matches
                 }
-                yara_results['results'].append(result)
-                
+            
                 # Print matches as we find them
                 for match in matches:
                     severity = match.get('meta', {}).get('severity', 'unknown')
-                    print(f"  [!] {file_path}: {match['rule']} (severity: {severity})", file=sys.stderr)
+                    if severity in HIGH_SEVERITIES:
+                        totals['highSeverityMatches'] += 1
+                    print(f"  [!] {file_path}: {match['rule']} (severity: {severity})", file=log)
+            
+                yield result
+        
+        if scanned % 10 != 0:
+            print(f"  Progress: {scanned} files", file=log)
+    finally:
+        flush_log(log)
+
+
+def _translate_glob_set(chars: str) -> str:
+    """Translate the body of a glob '[...]' set into a regex class, as fnmatch.translate() does."""
+    # Split on range dashes; a '-' first or last in the set is literal
+    chunks = []
+    start, k = 0, 2 if chars.startswith('!') else 1
+    while True:
+        k = chars.find('-', k)
+        if k < 0:
+            break
+        chunks.append(chars[start:k])
+        start, k = k + 1, k + 3
+    if chars[start:]:
+        chunks.append(chars[start:])
+    else:
+        chunks[-1] += '-'
+    # Empty ranges such as 'z-a' match nothing and are invalid in a regex
+    for k in range(len(chunks) - 1, 0, -1):
+        if chunks[k - 1][-1] > chunks[k][0]:
+            chunks[k - 1] = chunks[k - 1][:-1] + chunks[k][1:]
+            del chunks[k]
+    chars = '-'.join(chunk.replace('\\', '\\\\').replace('-', '\\-') for chunk in chunks)
+    chars = re.sub(r'([\[&~|])', r'\\\1', chars)
     
-    return yara_results
+    if not chars:
+        return '(?!)'
+    if chars.startswith('!'):
+        # A negated set must not match the separator either; a leading ']'
+        # is escaped so it stays in the set after the '/'
+        chars = chars[1:]
+        if chars.startswith(']'):
+            chars = '\\' + chars
+        return f"[^/{chars}]"
+    if chars.startswith('^'):
+        chars = '\\' + chars
+    return f"[{chars}]"
+
+
+def _translate_glob_segment(segment: str) -> str:
+    """Translate one path segment of a glob pattern into a regex that stays within the segment."""
+    regex = []
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == '*':
+            # Runs of '*' mean the same as one
+            while i < len(segment) and segment[i] == '*':
+                i += 1
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[':
+            # A leading '!' negates the set and a ']' right after it is literal
+            end = i
+            if segment[end:end + 1] == '!':
+                end += 1
+            if segment[end:end + 1] == ']':
+                end += 1
+            end = segment.find(']', end)
+            if end < 0:
+                regex.append('\\[')
+                continue
+            regex.append(_translate_glob_set(segment[i:end]))
+            i = end + 1
+        else:
+            regex.append(re.escape(char))
+    return ''.join(regex)
 
 
-def scan_directory(rules: yara.Rules, directory: str, timeout: int = 60, include_patterns: list[str] = None) -> dict:
+def compile_include_patterns(include_patterns: list[str]) -> tuple[re.Pattern, bool]:
+    """
+    Combine glob patterns into a single regex matched against relative paths.
+    
+    Patterns follow Path.rglob() semantics: each one may match at any depth,
+    '*' and '?' do not cross directory separators, and a '**' segment matches
+    any number of directories. This lets one walk of the tree test every file
+    against all patterns at once.
+    
+    When no pattern has a directory part, which is the usual case
+    (e.g. '*.js'), the regex is built for bare file names instead, so the
+    walk can test entry names without building a relative path per file.
+    
+    Args:
+        include_patterns: List of glob patterns (e.g., ['*.js', 'dist/*.html'])
+        
+    Returns:
+        Compiled regex, and whether it must be matched against paths relative
+        to the scanned directory (using '/') rather than file names
+    """
+    match_paths = any('/' in pattern.strip('/') for pattern in include_patterns)
+    
+    alternatives = []
+    for pattern in include_patterns:
+        regex = '(?:[^/]+/)*' if match_paths else ''
+        segments = pattern.strip('/').split('/')
+        for i, segment in enumerate(segments):
+            last = i == len(segments) - 1
+            if segment == '**':
+                regex += '.*' if last else '(?:[^/]+/)*'
+            else:
+                regex += _translate_glob_segment(segment) + ('' if last else '/')
+        alternatives.append(regex)
+    
+    flags = re.DOTALL | (re.IGNORECASE if os.name == 'nt' else 0)
+    return re.compile('(?:' + '|'.join(alternatives) + ')\\Z', flags), match_paths
+
+
+def iter_files(directory: str, include: Optional[re.Pattern] = None, match_paths: bool = True) -> Iterator[str]:
+    """
+    Walk a directory tree, yielding paths of regular files.
+    
+    Symlinked files are scanned, as Path.rglob() did, but symlinked
+    directories are not walked, so linked package directories are not
+    scanned twice and link cycles cannot recurse forever.
+    
+    Args:
+        directory: Directory to walk
+        include: Regex from compile_include_patterns() that files must match,
+            or None for all files
+        match_paths: Match include against paths relative to directory
+            rather than file names
+        
+    Yields:
+        Path of each matching file
+    """
+    prefix_length = len(os.path.join(directory, ''))
+    
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        subdirs = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        if include is not None:
+                            if match_paths:
+                                name = entry.path[prefix_length:]
+                                if os.sep != '/':
+                                    name = name.replace(os.sep, '/')
+                            else:
+                                name = entry.name
+                            if not include.match(name):
+                                continue
+                        yield entry.path
+        except OSError as e:
+            print(f"Warning: Cannot read directory {current}: {e}", file=sys.stderr)
+        # Reversed so subdirectories are walked in the order they were listed
+        pending.extend(reversed(subdirs))
+
+
+def scan_directory(rules: yara.Rules, directory: str, totals: dict, timeout: int = 60,
+                   include_patterns: list[str] = None, workers: int = 1,
+                   skip_exts: frozenset = SKIP_EXTS, max_size: Optional[int] = None) -> Iterator[dict]:
     """
     Scan files in a directory recursively, optionally filtering by patterns.
     
     Args:
         rules: Compiled YARA rules
         directory: Directory to scan
+        totals: Counters from new_totals(), updated as files are scanned
         timeout: Scan timeout per file
         include_patterns: List of glob patterns to include (e.g., ['*.js', '*.html'])
+        workers: Number of worker processes
+        skip_exts: Lowercase file extensions to skip
+        max_size: Skip files larger than this many bytes, or None for no limit
         
-    Returns:
-        Dictionary with scan results
+    Yields:
+        Result dictionary for each file with matches
     """
-    yara_results = {
-        'totalScanned': 0,
-        'totalMatches': 0,
-        'filesWithMatches': 0,
-        'results': []
-    }
-    
-    dir_path = Path(directory)
-    
-    # Collect files matching patterns
-    if include_patterns:
-        files = []
-        for pattern in include_patterns:
-            files.extend(dir_path.rglob(pattern))
-        # Remove duplicates while preserving order
-        files = list(dict.fromkeys(files))
-    else:
-        files = list(dir_path.rglob('*'))
+    # Collect files matching patterns in a single walk
+    include, match_paths = compile_include_patterns(include_patterns) if include_patterns else (None, False)
+    files = []
+    for file_path in iter_files(directory, include, match_paths):
+        try:
+            size = os.stat(file_path).st_size
+        except OSError as e:
+            print(f"Warning: Cannot stat {file_path}: {e}", file=sys.stderr)
+            continue
+        
+        if is_skipped(file_path, size, skip_exts, max_size):
+            totals['totalSkipped'] += 1
+        else:
+            files.append((file_path, size))
     
-    files = [f for f in files if f.is_file()]
+    # Result paths are reported relative to the scanned directory
+    prefix_length = len(os.path.join(directory, ''))
     
     print(f"\nScanning {len(files)} files with YARA...", file=sys.stderr)
     
-    for i, file_path in enumerate(files):
-        if (i + 1) % 10 == 0 or (i + 1) == len(files):
-            print(f"  Progress: {i + 1}/{len(files)}", file=sys.stderr)
-        
-        matches = scan_file(rules, str(file_path), timeout)
-        
-        yara_results['totalScanned'] += 1
+    # Progress and match lines are written to stderr together at each
+    # progress update rather than one write per line
+    log = io.StringIO()
+    
+    targets = ((file_path, file_path, size) for file_path, size in files)
+    try:
+        for i, (file_path, matches) in enumerate(scan_files(rules, targets, timeout, workers)):
+            if (i + 1) % 10 == 0 or (i + 1) == len(files):
+                print(f"  Progress: {i + 1}/{len(files)}", file=log)
+                flush_log(log)
+            
+            totals['totalScanned'] += 1
         
-        if matches:
-            yara_results['totalMatches'] += len(matches)
-            yara_results['filesWithMatches'] += 1
+            if matches:
+                totals['totalMatches'] += len(matches)
+                totals['filesWithMatches'] += 1
             
-            result = {
-                'file': str(file_path.relative_to(dir_path)),
-                'matches': matches
-            }
-            yara_results['results'].append(result)
+                result = {
+                    'file': file_path[prefix_length:],
+                    'matches': matches
+                }
             
-            for match in matches:
-                severity = match.get('meta', {}).get('severity', 'unknown')
-                print(f"  [!] {file_path}: {match['rule']} (severity: {severity})", file=sys.stderr)
+                for match in matches:
+                    severity = match.get('meta', {}).get('severity', 'unknown')
+                    if severity in HIGH_SEVERITIES:
+                        totals['highSeverityMatches'] += 1
+                    print(f"  [!] {file_path}: {match['rule']} (severity: {severity})", file=log)
+            
+                yield result
+    finally:
+        flush_log(log)
+
+
+def dumps_json(obj: Any, pretty: bool = False) -> bytes:
+    """
+    Serialize an object to UTF-8 JSON, using orjson when it is installed.
+    
+    Args:
+        obj: Object to serialize
+        pretty: Indent with two spaces instead of writing compact JSON
+        
+    Returns:
+        Encoded JSON document
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+        except orjson.JSONEncodeError:
+            # orjson rejects strings that are not valid UTF-8, such as file
+            # names with undecodable bytes; json escapes them instead
+            pass
+    if pretty:
+        return json.dumps(obj, indent=2).encode()
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def write_results(out: BinaryIO, results: Iterable[dict], totals: dict, pretty: bool = False) -> None:
+    """
+    Stream scan results to a file as a single JSON document.
     
-    return yara_results
+    Each result is serialized as soon as the scanner produces it, and the
+    counters are written after the results array once scanning finishes.
+    
+    Args:
+        out: Binary stream to write to
+        results: Result dictionaries from scan_files_from_json or scan_directory
+        totals: Scan counters, complete once results is exhausted
+        pretty: Indent the output for readability
+    """
+    if pretty:
+        out.write(b'{\n  "results": [')
+        separator = b'\n'
+        for result in results:
+            out.write(separator + b'    ' + dumps_json(result, pretty=True).replace(b'\n', b'\n    '))
+            separator = b',\n'
+        out.write(b'\n  ],' if separator != b'\n' else b'],')
+        # Drop the opening brace so the counters continue the same object
+        out.write(dumps_json(totals, pretty=True)[1:] + b'\n')
+    else:
+        out.write(b'{"results":[')
+        separator = b''
+        for result in results:
+            out.write(separator + dumps_json(result))
+            separator = b','
+        out.write(b'],' + dumps_json(totals)[1:] + b'\n')
 
 
-def emit_github_annotations(results: dict) -> int:
+def emit_github_annotations(results: list[dict]) -> int:
     """
     Emit GitHub Actions annotations for YARA matches.
     
     Args:
-        results: YARA scan results
+        results: YARA scan result dictionaries
         
     Returns:
         Count of high severity matches
     """
     high_severity_count = 0
+    lines = []
     
-    for result in results.get('results', []):
+    for result in results:
         file_path = result.get('file', 'unknown')
         package = result.get('package', '')
         
+        location = f"{package}: {file_path}" if package else file_path
+        
         for match in result.get('matches', []):
-            rule = match.get('rule', 'unknown')
-            severity = match.get('meta', {}).get('severity', 'unknown')
-            description = match.get('meta', {}).get('description', '')
-            category = match.get('meta', {}).get('category', '')
+            meta = match.get('meta') or _EMPTY
+            severity = meta.get('severity', 'unknown')
+            description = meta.get('description', '')
+            
+            prefix = _SEV_PREFIX.get(severity, '::notice')
+            if prefix == '::error':
+                high_severity_count += 1
             
-            message = f"{file_path}"
-            if package:
-                message = f"{package}: {file_path}"
-            message += f" - {rule}"
+            message = f"{location} - {match.get('rule', 'unknown')}"
             if description:
                 message += f" ({description})"
             
-            if severity == 'critical' or severity == 'high':
-                print(f"::error title=YARA {severity.upper()} - {category}::{message}")
-                high_severity_count += 1
-            elif severity == 'medium':
-                print(f"::warning title=YARA {severity.upper()} - {category}::{message}")
-            else:
-                print(f"::notice title=YARA {severity.upper()} - {category}::{message}")
+            lines.append(f"{prefix} title=YARA {severity.upper()} - {meta.get('category', '')}::{message}")
+    
+    # Write all annotations at once instead of one print per match
+    if lines:
+        write_lines(sys.stdout, lines)
     
     return high_severity_count
 
@@ -335,12 +955,46 @@ Examples:
         '--output', '-o',
         help='Output file for JSON results (default: stdout)'
     )
+    parser.add_argument(
+        '--max-size',
+        type=int,
+        help='Skip files larger than this many megabytes (default: no limit)'
+    )
+    parser.add_argument(
+        '--skip-ext',
+        action='append',
+        default=[],
+        help='File extension to skip (e.g., ".svg"). Can be specified multiple times.'
+    )
+    parser.add_argument(
+        '--no-default-skip-ext',
+        action='store_true',
+        help=f'Do not skip the default extensions ({", ".join(sorted(SKIP_EXTS))}). '
+             'The defaults only apply to --dir, and those named by an --include '
+             'pattern are never skipped.'
+    )
+    parser.add_argument(
+        '--pretty',
+        action='store_true',
+        help='Indent the JSON output'
+    )
     parser.add_argument(
         '--timeout', '-t',
         type=int,
         default=60,
         help='Scan timeout per file in seconds (default: 60)'
     )
+    parser.add_argument(
+        '--no-rule-cache',
+        action='store_true',
+        help='Always recompile rules instead of using the compiled rules cache'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of parallel scan processes (default: CPU count)'
+    )
     parser.add_argument(
         '--github-annotations',
         action='store_true',
@@ -378,42 +1032,75 @@ Examples:
         sys.exit(1)
     
     # Load rules
-    rules = load_rules(rules_paths)
+    rules = load_rules(rules_paths, use_cache=not args.no_rule_cache)
     if not rules:
         print("Error: Failed to load YARA rules", file=sys.stderr)
         sys.exit(1)
     
+    # Files to leave out of the scan. The default extensions only apply to
+    # --dir: scanner.js lists binaries found by their magic bytes, so an ELF
+    # named evil.png in its report must still be scanned
+    skip_exts = set(SKIP_EXTS) if args.dir and not args.no_default_skip_ext else set()
+    # An explicit --include wins over the default skip list, so
+    # --include "*.map" scans .map files
+    if args.dir and args.include:
+        skip_exts = {ext for ext in skip_exts
+                     if not any(pattern.lower().endswith(ext) for pattern in args.include)}
+    for ext in args.skip_ext:
+        ext = ext.lower()
+        skip_exts.add(ext if ext.startswith('.') else f".{ext}")
+    skip_exts = frozenset(skip_exts)
+    max_size = args.max_size * 1024 * 1024 if args.max_size is not None else None
+    
     # Scan
+    totals = new_totals()
     if args.input:
-        results = scan_files_from_json(rules, args.input, args.timeout)
+        results = scan_files_from_json(rules, args.input, totals, args.timeout, args.workers,
+                                       skip_exts, max_size)
     else:
         include_patterns = args.include if args.include else None
-        results = scan_directory(rules, args.dir, args.timeout, include_patterns)
+        results = scan_directory(rules, args.dir, totals, args.timeout, include_patterns, args.workers,
+                                 skip_exts, max_size)
+    
+    # Annotations are emitted after the summary, so matched results are only
+    # held in memory when they are needed; otherwise they stream to the output
+    if args.github_annotations:
+        results = list(results)
+    
+    # Output
+    if args.output:
+        with open(args.output, 'wb') as f:
+            write_results(f, results, totals, args.pretty)
+    else:
+        sys.stdout.flush()
+        write_results(sys.stdout.buffer, results, totals, args.pretty)
+        sys.stdout.buffer.flush()
     
     # Summary
-    print(f"\n=== YARA Scan Summary ===", file=sys.stderr)
-    print(f"Files scanned: {results['totalScanned']}", file=sys.stderr)
-    print(f"Files with matches: {results['filesWithMatches']}", file=sys.stderr)
-    print(f"Total matches: {results['totalMatches']}", file=sys.stderr)
+    write_lines(sys.stderr, [
+        "\n=== YARA Scan Summary ===",
+        f"Files scanned: {totals['totalScanned']}",
+        f"Files skipped: {totals['totalSkipped']}",
+        f"Files with matches: {totals['filesWithMatches']}",
+        f"Total matches: {totals['totalMatches']}",
+        f"High severity matches: {totals['highSeverityMatches']}",
+    ])
     
     # GitHub annotations
+    lines = []
     if args.github_annotations:
         high_count = emit_github_annotations(results)
-        print(f"\nyara-matches={results['filesWithMatches']}", file=sys.stderr)
-        print(f"yara-high-severity={high_count}", file=sys.stderr)
-    
-    # Output
-    output_json = json.dumps(results, indent=2)
+        lines.append(f"\nyara-matches={totals['filesWithMatches']}")
+        lines.append(f"yara-high-severity={high_count}")
     
     if args.output:
-        with open(args.output, 'w') as f:
-            f.write(output_json)
-        print(f"\nResults written to: {args.output}", file=sys.stderr)
-    else:
-        print(output_json)
+        lines.append(f"\nResults written to: {args.output}")
+    
+    if lines:
+        write_lines(sys.stderr, lines)
     
     # Exit with error if high severity matches found
-    if results['filesWithMatches'] > 0:
+    if totals['filesWithMatches'] > 0:
         sys.exit(0)  # Don't fail, let the action decide based on outputs
     
     sys.exit(0)
@@ -421,4 +1108,3 @@ Examples:
 
 if __name__ == '__main__':
     main()
-